@@ -9,21 +9,26 @@
 import os
 import sys
 import pty
-import select
+import selectors
 import signal
 import time
-import base64
+import binascii
+import gzip
+import mmap
 
 from rossh_common import \
     rossh_version_index, \
     gen_term_id, \
     build_ctlseq, \
+    build_ctlseq_prefix, \
     find_ctlseq_param, \
     write_to, \
     write_to_master_fd, \
     forward_window_resize, \
     raw_tty, \
     lock_fd, \
+    set_blocking, \
+    MultiPatternMatcher, \
     PatternFinder
 
 banner = '''\
@@ -40,6 +45,15 @@ curdir = os.path.dirname(os.path.abspath(__file__))
 stdin_fileno = sys.stdin.fileno()
 stdout_fileno = sys.stdout.fileno()
 
+# read sizes. the steady-state forwarding loop reads large chunks to
+# keep bulk output (e.g., cat of a large file) from being syscall-bound,
+# while the connection setup reads stay small to not delay pattern
+# detection.
+MASTER_READ_SIZE = 65536
+MASTER_DRAIN_CHUNKS = 16
+STDIN_READ_SIZE = 8192
+INIT_READ_SIZE = 4096
+
 # set this to print robust client-server interactions.
 is_debug = False
 
@@ -47,13 +61,62 @@ is_debug = False
 # in unstable networks, this may generate a lot of logs.
 is_auto_reconnect = False
 
+# control sequences we look for, built once.
+_PAT_PROMPT = build_ctlseq('PROMPT')
+_PAT_PROMPT_STR = build_ctlseq('PROMPT', output_str=True)
+_PAT_KILLED = build_ctlseq_prefix('KILLed:')
+_PAT_CONN_S = build_ctlseq('CONN:S')
+_PAT_CONN_E = build_ctlseq('CONN:E')
+# the version error of old servers, which must still be recognized.
+_PAT_CONN_FL_VER_LEGACY = b'\x1b+CONN:FL:VER'
+_PAT_CONN_FL_VER_SERVER = build_ctlseq('CONN:FL:VER:SERVER_UPDATE')
+_PAT_CONN_FL_VER_CLIENT_TOOOLD = build_ctlseq('CONN:FL:VER:CLIENT_TOOOLD')
+
+# everything we look for in the server response, in one matcher.
+# the patterns are fixed, so the automaton is built once at import.
+_RESPONSE_MATCHER = MultiPatternMatcher([
+    _PAT_KILLED,
+    _PAT_CONN_S,
+    _PAT_CONN_FL_VER_LEGACY,
+    _PAT_CONN_FL_VER_SERVER,
+    _PAT_CONN_FL_VER_CLIENT_TOOOLD,
+    b'/usr/bin/env:',
+    b'No such file or directory',
+    _PAT_PROMPT,
+])
+
+_CONN_E_TAIL_LEN = len(_PAT_CONN_E) - 1
+
+def find_conn_end(tail, buf, n):
+    '''
+    Find CONN:E in tail + buf[:n] without copying buf, where tail is the
+    last _CONN_E_TAIL_LEN bytes before buf.
+    Return the offset in buf where it starts (negative if it starts
+    in tail), or None if not found.
+    '''
+    p = (tail + bytes(buf[:min(n, _CONN_E_TAIL_LEN)])).find(_PAT_CONN_E)
+    if p >= 0:
+        return p - len(tail)
+    p = buf.find(_PAT_CONN_E, 0, n)
+    return p if p >= 0 else None
+
+# shell errors that mean the server installation went wrong.
+install_error_markers = [
+    b'Permission denied',
+    b'No space left on device',
+    b'command not found',
+    # dash and busybox, e.g. "sh: 1: gunzip: not found".
+    b': not found',
+    b'not in gzip format',
+]
+
 class ConnectionError(Exception):
     pass
 
 class ConnectionFatalError(Exception):
     pass
 
-def arg_orphaned_sessions():
+def list_orphaned_sessions():
     ret = []
     for fname in os.listdir(curdir):
         if fname[:8] == '.orphan.':
@@ -65,39 +128,96 @@ def arg_orphaned_sessions():
                 # print('file %s locked' % fname)
                 locked = True
             if not locked: ret.append(fname[8:])
-    if ret:
-        return ' --kill ' + ' '.join(ret)
-    else:
-        return ''
+    return ret
 
 class ClientSession:
     def __init__(self, term_id, args):
         self.term_id = term_id
         self.args = args
+        # orphaned sessions from previous runs, see arg_orphaned_sessions.
+        self._orphan_cache = None
+        # scratch buffers of the forwarding loop, reused for every read.
+        self._read_buf = bytearray(MASTER_READ_SIZE * MASTER_DRAIN_CHUNKS)
+        self._stdin_buf = bytearray(STDIN_READ_SIZE)
+
+    def arg_orphaned_sessions(self):
+        # the directory is only scanned on the first connect. after that,
+        # we keep the list up to date ourselves as sessions get killed.
+        # our own .orphan file is locked and never shows up in it.
+        if self._orphan_cache is None:
+            self._orphan_cache = list_orphaned_sessions()
+        if self._orphan_cache:
+            return ' --kill ' + ' '.join(self._orphan_cache)
+        else:
+            return ''
 
     def init_connection(self, master_fd):
+        '''
+        Bring the ssh session at master_fd up to a connected RoSSH server.
+        It goes through three phases, each of which only looks for the
+        patterns that matter to it: wait_shell until we get a shell,
+        wait_server for the reply to our server command, and
+        install_server if the shell prompt comes back instead.
+        Installation is tried at most once.
+        '''
         pattern_finder = PatternFinder()
         with raw_tty():
-            fds = [master_fd, stdin_fileno]
+            self.wait_shell(master_fd, pattern_finder)
+
+            # after ssh establishment, we set up the remote server.
+            # only the orphaned sessions to kill may change between tries.
+            server_cmd = \
+                ' (unset PS1 PS2 PS3 && env TERM=\'%s\' ' \
+                '~/.rossh/rossh_server.py -V %d -t %s' % (
+                    os.environ.get('TERM', ''),
+                    rossh_version_index, self.term_id)
+            for is_second_try in [False, True]:
+                write_to(
+                    master_fd,
+                    bytes('%s %s && exit)\n' %
+                          (server_cmd, self.arg_orphaned_sessions()),
+                          encoding='utf-8'))
+
+                status = self.wait_server(master_fd, pattern_finder)
+                if status == 'connected':
+                    return
+
+                # by any consequence, we are bounced back to the
+                # shell prompt. we try to install / upgrade the server.
+                if is_second_try:
+                    raise ConnectionError(
+                        'Failed even after installation. '
+                        'Please report this to GitHub issues: '
+                        'https://github.com/gzz2000/RoSSH/issues')
+                self.install_server(master_fd, pattern_finder,
+                                    is_upgrade=(status == 'outdated'))
+                # now, we fall back to the second try...
+
+        assert False, 'unreachable'
+
+    def wait_shell(self, master_fd, pattern_finder):
+        '''
+        Connect the SSH terminal to stdin/stdout until its shell gives
+        us the first PROMPT, for entering password, etc.
+        '''
+        with selectors.DefaultSelector() as sel:
+            sel.register(master_fd, selectors.EVENT_READ)
+            sel.register(stdin_fileno, selectors.EVENT_READ)
 
-            # loop until ssh established (with a shell for us).
             while True:
-                rfds, _, _ = select.select(fds, [], [])
+                rfds = [key.fd for key, _ in sel.select()]
 
                 if master_fd in rfds:
-                    data = os.read(master_fd, 1024)
+                    data = os.read(master_fd, INIT_READ_SIZE)
                     if is_debug: write_to(stdout_fileno, b'{' + data + b'}')
                     if not data:
                         raise ConnectionError('Master fd closed')
 
-                    # before connection establishes, connect the SSH
-                    # terminal to stdin/stdout, for entering password, etc.
-
                     found_prompt = pattern_finder.find_with_tail(
-                        data, build_ctlseq('PROMPT'))
+                        data, _PAT_PROMPT)
                     if found_prompt:
                         write_to(stdout_fileno, found_prompt[0])
-                        break
+                        return
 
                     pattern_finder.append(data)
                     # write out server messages (like request for password
@@ -107,151 +227,209 @@ class ClientSession:
                 # before ssh establishment, we allow stdin interaction
                 # for user authentication (e.g., password input).
                 if stdin_fileno in rfds:
-                    data = os.read(stdin_fileno, 1024)
-                    write_to(master_fd, data)
-
-            # after ssh establishment, we set up the remote server.
-            for is_second_try in [False, True]:
-                term_environ = '' if 'TERM' not in os.environ else \
-                    os.environ['TERM']
-                write_to(
-                    master_fd,
-                    b' (unset PS1 PS2 PS3 && env TERM=\'' +
-                    bytes(term_environ, encoding='utf-8') + \
-                    b'\' ' +
-                    bytes('~/.rossh/rossh_server.py -V %d -t %s %s' %
-                          (rossh_version_index, self.term_id,
-                           arg_orphaned_sessions()),
-                          encoding='utf-8') +
-                    b' && exit)\n')
-
-                # loop for server response.
-                # either the connection is established and our server
-                # returns a special message => we exit the function,
-                # or, something wrong happens, and then we try to solve it.
-                is_server_old_version = False
-                while True:
-                    data = os.read(master_fd, 1024)
-                    if is_debug: write_to(stdout_fileno, b'{' + data + b'}')
-                    if not data:
-                        raise ConnectionError('Master fd closed after ssh')
-
-                    # orphan kill information
-                    # not robust with patternfinder here, because im lazy..
-                    killed_term_id, remain_data = find_ctlseq_param(
-                        data, 'KILLed:', output_str=True)
-                    if killed_term_id is not None:
-                        print('[RoSSH] killed orphaned session %s\r'
-                              % killed_term_id)
+                    n = os.readv(stdin_fileno, [self._stdin_buf])
+                    write_to(master_fd, memoryview(self._stdin_buf)[:n])
+
+    def wait_server(self, master_fd, pattern_finder):
+        '''
+        Read the response to our server command.
+        Return 'connected' if the server is up and attached. If we are
+        bounced back to the shell prompt instead, return 'outdated' if
+        the server told us it is too old, or 'missing' otherwise.
+        '''
+        is_server_old_version = False
+        while True:
+            data = os.read(master_fd, INIT_READ_SIZE)
+            if is_debug: write_to(stdout_fileno, b'{' + data + b'}')
+            if not data:
+                raise ConnectionError('Master fd closed after ssh')
+
+            found = pattern_finder.find_any_with_tail(
+                data, _RESPONSE_MATCHER)
+
+            # orphan kill information
+            # not robust with patternfinder here, because im lazy..
+            killed_term_id = None
+            if _PAT_KILLED in found:
+                killed_term_id, remain_data = find_ctlseq_param(
+                    data, 'KILLed:', output_str=True)
+            if killed_term_id is not None:
+                print('[RoSSH] killed orphaned session %s\r'
+                      % killed_term_id)
+                if killed_term_id in self._orphan_cache:
+                    self._orphan_cache.remove(killed_term_id)
+                try:
+                    os.unlink(os.path.join(
+                        curdir, '.orphan.%s' % killed_term_id))
+                except Exception as e:
+                    print(e, '\r')
+                data = remain_data
+
+            # connection success, exit
+            if _PAT_CONN_S in found:
+                found_success = pattern_finder.find_with_tail(
+                    data, _PAT_CONN_S)
+                if found_success:
+                    write_to(stdout_fileno, found_success[1])
+                    return 'connected'
+
+            # server has an old version
+            # the version error must respect previous versions.
+            if _PAT_CONN_FL_VER_LEGACY in found or \
+               _PAT_CONN_FL_VER_SERVER in found:
+                is_server_old_version = True
+
+            if _PAT_CONN_FL_VER_CLIENT_TOOOLD in found:
+                raise ConnectionFatalError(
+                    'This client version (' +
+                    str(rossh_version_index) +
+                    ') is older than the server-installed '
+                    'RoSSH version. Please upgrade your client.')
+
+            if b'/usr/bin/env:' in found and \
+               b'No such file or directory' in found:
+                print('[RoSSH] No Python 3 found at remote server. '
+                      'You must install one to use RoSSH.\r')
+                raise ConnectionFatalError('No python 3 found.')
+
+            pattern_finder.append(data)
+            if _PAT_PROMPT in found:
+                return 'outdated' if is_server_old_version else 'missing'
+
+            # continue looking for PROMPTs / success..
+
+    def install_server(self, master_fd, pattern_finder, is_upgrade):
+        '''
+        Copy RoSSH to ~/.rossh at the remote shell, which is waiting at
+        its prompt.
+        '''
+        if is_upgrade:
+            print('[RoSSH] Upgrading RoSSH '
+                  'at remote server ...\r')
+        else:
+            print('[RoSSH] Copying RoSSH '
+                  'to remote server ~/.rossh ...\r')
+
+        # commands are pipelined: send_cmd only queues a
+        # command, and drain_prompts writes all of them to
+        # the shell back-to-back and then waits for their
+        # PROMPTs. so the install takes one round trip
+        # instead of one per command.
+        # if heredoc is given, it is sent as the body of
+        # the here-document that cmd opens with
+        # <<'ROSSH_EOF'. it is fine as PS2 is empty and we
+        # still get exactly one PROMPT back.
+        upload_eof = b'ROSSH_EOF'
+        cmd_queue = []
+        def send_cmd(cmd, heredoc=None):
+            assert b'\n' not in cmd
+            if heredoc is None:
+                cmd_queue.append(b' %s\n' % cmd)
+            else:
+                cmd_queue.append(b' %s\n%s%s\n' % (
+                    cmd, heredoc, upload_eof))
+
+        def drain_prompts(n):
+            outbuf = memoryview(b''.join(cmd_queue))
+            del cmd_queue[:]
+            output = []
+            # keep reading while we write. otherwise the
+            # remote echo may fill up the pty and block us.
+            set_blocking(master_fd, False)
+            try:
+                with selectors.DefaultSelector() as isel:
+                    isel.register(
+                        master_fd,
+                        selectors.EVENT_READ |
+                        selectors.EVENT_WRITE)
+                    while n:
+                        events = 0
+                        for _, ev in isel.select():
+                            events |= ev
+                        if events & selectors.EVENT_WRITE:
+                            try:
+                                outbuf = outbuf[os.write(
+                                    master_fd, outbuf):]
+                            except BlockingIOError:
+                                pass
+                            if not outbuf:
+                                isel.modify(
+                                    master_fd,
+                                    selectors.EVENT_READ)
+                        if not events & selectors.EVENT_READ:
+                            continue
                         try:
-                            os.unlink(os.path.join(
-                                curdir, '.orphan.%s' % killed_term_id))
-                        except Exception as e:
-                            print(e, '\r')
-                        data = remain_data
-
-                    # connection success, exit
-                    found_success = pattern_finder.find_with_tail(
-                        data, build_ctlseq('CONN:S')
-                    )
-                    if found_success:
-                        write_to(stdout_fileno, found_success[1])
-                        return
-
-                    # server has an old version
-                    # the version error must respect previous versions.
-                    if pattern_finder.find_with_tail(data, b'\x1b+CONN:FL:VER') or \
-                       pattern_finder.find_with_tail(
-                           data, build_ctlseq('CONN:FL:VER:SERVER_UPDATE')):
-                        is_server_old_version = True
-
-                    if pattern_finder.find_with_tail(
-                           data, build_ctlseq('CONN:FL:VER:CLIENT_TOOOLD')):
-                        raise ConnectionFatalError(
-                            'This client version (' +
-                            str(rossh_version_index) +
-                            ') is older than the server-installed '
-                            'RoSSH version. Please upgrade your client.')
-
-                    if pattern_finder.find_with_tail(
-                            data, b'/usr/bin/env:') and \
-                       pattern_finder.find_with_tail(
-                            data, b'No such file or directory'):
-                        print('[RoSSH] No Python 3 found at remote server. '
-                              'You must install one to use RoSSH.\r')
-                        raise ConnectionFatalError('No python 3 found.')
-
-                    # by any consequence, we are bounced back to the
-                    # shell prompt. we try to install / upgrade the server.
-                    if pattern_finder.find_with_tail(
-                            data, build_ctlseq('PROMPT')):
-                        pattern_finder.append(data)
-                        
-                        if is_second_try:
-                            raise ConnectionError(
-                                'Failed even after installation. '
-                                'Please report this to GitHub issues: '
-                                'https://github.com/gzz2000/RoSSH/issues')
-                        
-                        if is_server_old_version:
-                            print('[RoSSH] Upgrading RoSSH '
-                                  'at remote server ...\r')
-                        else:
-                            print('[RoSSH] Copying RoSSH '
-                                  'to remote server ~/.rossh ...\r')
-
-                        # run a command and wait for success response.
-                        # this seems to be more robust.
-                        def run_cmd(cmd):
-                            assert b'\n' not in cmd
-                            write_to(master_fd, b' ' + cmd + b'\n')
-                            while True:
-                                data = os.read(master_fd, 4096)
-                                if is_debug: write_to(stdout_fileno, b'{' + data + b'}')
-                                if not data:
-                                    raise RuntimeError(
-                                        'Unexpected EOF running command')
-                                if pattern_finder.find_with_tail(
-                                        data, build_ctlseq('PROMPT')):
-                                    pattern_finder.append(data)
-                                    break
-                                pattern_finder.append(data)
-
-                        # instructions = bytes()
-                        run_cmd(b'mkdir -p ~/.rossh')
-                        run_cmd(b'chmod go-w ~/.rossh')
-                        run_cmd(b'cd ~/.rossh')
-
-                        for fname in ['rossh_client.py',
-                                      'rossh_server.py',
-                                      'rossh_common.py']:
-                            run_cmd(b'rm ' + bytes(fname, encoding='utf-8'))
-                            with open(os.path.join(curdir, fname), 'rb') as f:
-                                while True:
-                                    data = f.read(1023)
-                                    if not data:
-                                        break
-                                    run_cmd(b'echo "' +
-                                            base64.b64encode(data) +
-                                            b'" | base64 -d >> ' +
-                                            bytes(fname, encoding='utf-8'))
-
-                        run_cmd(b'chmod go-w,+x *')
-                        run_cmd(b'cd ~')
-                        # now, we fall back to the second try (outer loop)...
-                        break
-
-                    # continue looking for PROMPTs / success..
-                    pattern_finder.append(data)
-
-        assert False, 'unreachable'
+                            data = os.read(master_fd,
+                                           INIT_READ_SIZE)
+                        except BlockingIOError:
+                            continue
+                        if is_debug: write_to(stdout_fileno, b'{' + data + b'}')
+                        if not data:
+                            raise RuntimeError(
+                                'Unexpected EOF running command')
+                        output.append(data)
+                        # count PROMPTs, there may be more
+                        # than one in a chunk.
+                        # data is searched from pos on, instead of
+                        # slicing it.
+                        pos = 0
+                        while n:
+                            found = pattern_finder.find_with_tail(
+                                data, _PAT_PROMPT, pos)
+                            if not found:
+                                break
+                            end = len(data) - len(found[1])
+                            pattern_finder.append(
+                                memoryview(data)[pos:end])
+                            pos = end
+                            n -= 1
+                        pattern_finder.append(memoryview(data)[pos:])
+            finally:
+                set_blocking(master_fd, True)
+
+            output = b''.join(output)
+            for marker in install_error_markers:
+                if marker in output:
+                    raise ConnectionFatalError(
+                        'Failed to install RoSSH at '
+                        'remote server: %s' %
+                        marker.decode('utf-8'))
+
+        send_cmd(b'mkdir -p ~/.rossh')
+        send_cmd(b'chmod go-w ~/.rossh')
+        send_cmd(b'cd ~/.rossh')
+
+        # each file is sent compressed, in a single
+        # heredoc. it is encoded in one b2a_base64 call
+        # and wrapped at 76 columns, well under the
+        # canonical tty line limit.
+        for fname in ['rossh_client.py',
+                      'rossh_server.py',
+                      'rossh_common.py']:
+            with open(os.path.join(curdir, fname),
+                      'rb') as f, \
+                 mmap.mmap(f.fileno(), 0,
+                           access=mmap.ACCESS_READ) as mm:
+                b64 = binascii.b2a_base64(
+                    gzip.compress(mm, 9))[:-1]
+            payload = b''.join(
+                [b64[i:i + 76] + b'\n'
+                 for i in range(0, len(b64), 76)])
+            send_cmd(b"base64 -d <<'%s' | gunzip > %s" % (
+                         upload_eof,
+                         bytes(fname, encoding='utf-8')),
+                     heredoc=payload)
+
+        send_cmd(b'chmod go-w,+x *')
+        send_cmd(b'cd ~')
+        drain_prompts(len(cmd_queue))
 
     def connect(self):
         args = self.args + \
                ['-t', 'exec', 'env',
                 'TERM=\'dumb\'',
                 'HISTCONTROL=\'ignoreboth\'',
-                'PS1=\'' + build_ctlseq('PROMPT', output_str=True) + '\'',
+                'PS1=\'' + _PAT_PROMPT_STR + '\'',
                 'PS2=\'\'',
                 'PS3=\'\'',
                 '/bin/sh']
@@ -353,36 +531,74 @@ class ClientSession:
                         '.orphan.%s' % self.term_id), 'w')
                 lock_fd(f_session_orphan)
 
-            try:
-                pattern_finder = PatternFinder()
-                with raw_tty(), forward_window_resize(master_fd, indirect=False):
-                    fds = [master_fd, stdin_fileno]
+            # non-blocking, so that the forwarding loop can drain the pty
+            # until it runs dry and then go back to waiting.
+            # stdin stays blocking. it is shared with the shell we were
+            # started from.
+            set_blocking(master_fd, False)
+
+            # registered once per connection, instead of handing the
+            # fd set to the kernel again on every wakeup.
+            sel = selectors.DefaultSelector()
+            sel.register(master_fd, selectors.EVENT_READ)
+            sel.register(stdin_fileno, selectors.EVENT_READ)
 
+            try:
+                # only CONN:E matters from here on. so instead of a
+                # PatternFinder, we just keep the few bytes needed to see
+                # it split between two wakeups.
+                end_tail = b''
+                buf = self._read_buf
+                buf_mv = memoryview(buf)
+                stdin_mv = memoryview(self._stdin_buf)
+                with raw_tty(), forward_window_resize(
+                        master_fd, indirect=False, selector=sel):
                     while True:
-                        rfds, _, _ = select.select(fds, [], [])
+                        rfds = []
+                        for key, _ in sel.select():
+                            if key.data is not None:
+                                # a callback, i.e., the window resize.
+                                key.data()
+                            else:
+                                rfds.append(key.fd)
 
                         if stdin_fileno in rfds:
-                            data = os.read(stdin_fileno, 1024)
-                            write_to(master_fd, data)
+                            n = os.readv(stdin_fileno, [self._stdin_buf])
+                            write_to(master_fd, stdin_mv[:n])
 
                         if master_fd in rfds:
-                            data = os.read(master_fd, 1024)
-                            if is_debug: write_to(stdout_fileno, data)
-                            if not data:
-                                print('\r\n[RoSSH] SSH disconnected.\r')
-                                # no longer reconnect automatically
-                                skip_reconnect = not is_auto_reconnect
-                                break
-
-                            # before connection establishes,
-                            # connect the SSH terminal
-                            # to stdin/stdout,
-                            # for entering password, etc.
+                            # drain what the pty has for us in this cycle
+                            # into one buffer. it is scanned and written
+                            # out once, however many reads it took.
+                            # the bytes have to pass through user space
+                            # (no os.splice): CONN:E may be anywhere in
+                            # the stream, and neither the pty nor stdout
+                            # is a pipe that splice could work on.
+                            n = 0
+                            is_eof = False
+                            while n < len(buf):
+                                try:
+                                    nread = os.readv(
+                                        master_fd,
+                                        [buf_mv[n:n + MASTER_READ_SIZE]])
+                                except BlockingIOError:
+                                    break
+                                except OSError:
+                                    # flush what we have got first.
+                                    # the error shows up again next cycle.
+                                    if n:
+                                        break
+                                    raise
+                                if not nread:
+                                    is_eof = True
+                                    break
+                                n += nread
+                            if is_debug: write_to(stdout_fileno, buf_mv[:n])
 
-                            found_end = pattern_finder.find_with_tail(
-                                data, build_ctlseq('CONN:E'))
-                            if found_end:
-                                write_to(stdout_fileno, found_end[0])
+                            end_at = find_conn_end(end_tail, buf, n)
+                            if end_at is not None:
+                                write_to(stdout_fileno,
+                                         buf_mv[:max(end_at, 0)])
                                 f_session_orphan.close()
                                 os.unlink(os.path.join(
                                     curdir, '.orphan.%s' % self.term_id))
@@ -390,15 +606,26 @@ class ClientSession:
                                     print('\r[RoSSH] Exited gracefully.\r')
                                 return
 
-                            pattern_finder.append(data)
-                            write_to(stdout_fileno, data)
-                            
+                            end_tail = (end_tail + bytes(
+                                buf[max(n - _CONN_E_TAIL_LEN, 0):n])
+                            )[-_CONN_E_TAIL_LEN:]
+                            # skip the call entirely on a wakeup that
+                            # brought nothing, e.g. right before EOF.
+                            if n:
+                                write_to(stdout_fileno, buf_mv[:n])
+                            if is_eof:
+                                print('\r\n[RoSSH] SSH disconnected.\r')
+                                # no longer reconnect automatically
+                                skip_reconnect = not is_auto_reconnect
+                                break
+
             except IOError as e:
                 print('\r\n[RoSSH] SSH disconnected.\r')
                 skip_reconnect = not is_auto_reconnect
                 continue
             
             finally:
+                sel.close()
                 try:
                     os.close(master_fd)
                 except OSError:
@@ -411,7 +638,10 @@ class ClientSession:
                 ssh_pid, master_fd = None, None
 
 if __name__ == '__main__':
-    print(banner)
+    # the banner is for humans. skip it when the output is piped
+    # or logged by a script.
+    if sys.stdout.isatty():
+        print(banner)
     if len(sys.argv) == 1:
         print('Usage: rossh <hostname> [..ssh options]')
         exit(1)
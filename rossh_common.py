@@ -7,33 +7,58 @@
 import os
 import fcntl
 import termios
-import contextlib
 import tty
 import sys
+import select
+import selectors
 import signal
-import random
-import string
+import binascii
 
-rossh_version_index = 5
+try:
+    # optional. used for a single-pass multi-pattern scan if available.
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
-ctlseq_special = 'rossh_173e6793-122c'
+rossh_version_index = 6
+
+ctlseq_special = b'rossh_173e6793-122c'
 ctlseq_begin = b'BC'
 ctlseq_end = b'ECrossh'
 
 def gen_term_id():
-    chars = string.ascii_uppercase + string.ascii_lowercase + string.digits
-    return ''.join(random.choice(chars) for _ in range(16))
+    # 16 hex digits from the OS random source in one call. the id ends up
+    # in file names and on the server command line, so it sticks to
+    # [0-9a-f] (and never starts with a '-').
+    return binascii.hexlify(os.urandom(8)).decode('ascii')
 
 def to_bytes(s):
+    # only used at the api boundary, where callers may pass str.
+    # internal hot paths pass bytes and skip it.
+    if isinstance(s, bytes):
+        return s
     if isinstance(s, str):
         return bytes(s, encoding='utf-8')
-    else:
-        return bytes(s)
+    return bytes(s)
+
+# the constant part of every control sequence, and the per-tag prefixes
+# built from it. tags are a handful of literals, so the cache stays small.
+_ctlseq_prefix = ctlseq_begin + ctlseq_special
+_begin_cache = {}
+
+def _begin_for(tag):
+    begin = _begin_cache.get(tag)
+    if begin is None:
+        begin = _begin_cache[tag] = _ctlseq_prefix + to_bytes(tag)
+    return begin
+
+def build_ctlseq_prefix(*args):
+    if not args:
+        return _ctlseq_prefix
+    return b''.join([_begin_for(args[0])] + [to_bytes(a) for a in args[1:]])
 
 def find_ctlseq_param(data, *args, output_str=False):
-    begin = ctlseq_begin + to_bytes(ctlseq_special)
-    for a in args:
-        begin += to_bytes(a)
+    begin = build_ctlseq_prefix(*args)
     st = data.find(begin)
     if st < 0:
         return None, None
@@ -47,104 +72,337 @@ def find_ctlseq_param(data, *args, output_str=False):
     return ret, data[ed + len(ctlseq_end):]
 
 def build_ctlseq(*args, output_str=False):
-    ret = ctlseq_begin + to_bytes(ctlseq_special)
-    for a in args:
-        ret += to_bytes(a)
-    ret += ctlseq_end
+    ret = build_ctlseq_prefix(*args) + ctlseq_end
     if output_str:
         ret = ret.decode('utf-8')
     return ret
 
+def wait_writable(fd):
+    select.select([], [fd], [])
+
+def is_readable(fd):
+    return bool(select.select([fd], [], [], 0)[0])
+
 def write_to(fd, data):
-    while data:
-        n = os.write(fd, data)
-        data = data[n:]
+    # a memoryview with an offset, so that a partial write does not
+    # copy the rest of data.
+    mv = memoryview(data)
+    off = 0
+    while off < len(mv):
+        try:
+            off += os.write(fd, mv[off:])
+        except BlockingIOError:
+            # fd is non-blocking and full. wait for it to drain.
+            wait_writable(fd)
+
+# the WS payload is a struct winsize of fixed size, so its end marker is
+# at a known offset and does not need to be searched for.
+_WS_BEGIN = _begin_for(b'WS')
+_WS_PAYLOAD_LEN = 8
 
-def write_to_master_fd(master_fd, data):
+def write_to_master_fd(master_fd, data, hold_prefix=True):
     '''
     Write all data to master_fd
     Interpret our special control characters, currently only:
     WS + <8 bytes struct winsize>: change window size
+    There may be any number of them anywhere in data.
+    Return the start of an escape that is cut off at the end of data,
+    or what may be one, to be passed again in front of the next data.
+    With hold_prefix=False, a tail that only looks like the beginning of
+    the escape prefix is written out instead, e.g. when no more data is
+    there to complete it.
     '''
-    ws, remain_data = find_ctlseq_param(data, 'WS')
-    if ws is not None:
-        fcntl.ioctl(master_fd, termios.TIOCSWINSZ, ws)
-        data = remain_data
-    while data:
-        n = os.write(master_fd, data)
-        data = data[n:]
-
-@contextlib.contextmanager
-def change_signal(signum, handler):
-    old_signal = signal.signal(signum, handler)
-    try:
-        yield
-    finally:
-        signal.signal(signum, old_signal)
+    if _WS_BEGIN[:1] not in data:
+        # neither an escape nor the start of one cut off at the end can
+        # be in data. this is the common case of a few keystrokes, which
+        # skip the search.
+        write_to(master_fd, data)
+        return b''
+    mv = memoryview(data)
+    pos = 0
+    while True:
+        st = data.find(_WS_BEGIN, pos)
+        if st < 0:
+            break
+        if st > pos:
+            write_to(master_fd, mv[pos:st])
+        ws = st + len(_WS_BEGIN)
+        ed = ws + _WS_PAYLOAD_LEN
+        if len(data) < ed + len(ctlseq_end):
+            return bytes(mv[st:])
+        if not data.startswith(ctlseq_end, ed):
+            raise RuntimeError('incomplete ctlseq param for WS')
+        fcntl.ioctl(master_fd, termios.TIOCSWINSZ, mv[ws:ed])
+        pos = ed + len(ctlseq_end)
+    # hold back the longest tail of data that may be the start of the
+    # prefix of an escape cut off by the read.
+    st = -1
+    if hold_prefix:
+        st = data.find(_WS_BEGIN[:1],
+                       max(pos, len(data) - len(_WS_BEGIN) + 1))
+        while st >= 0 and not _WS_BEGIN.startswith(bytes(mv[st:])):
+            st = data.find(_WS_BEGIN[:1], st + 1)
+    if st < 0:
+        st = len(data)
+    if st > pos:
+        write_to(master_fd, mv[pos:st])
+    return bytes(mv[st:])
 
-@contextlib.contextmanager
-def forward_window_resize(input_fileno, indirect):
+class ChangeSignal:
+    '''
+    Install handler for signum, and restore the old one on exit.
+    '''
+    def __init__(self, signum, handler):
+        self.signum = signum
+        self.handler = handler
+
+    def __enter__(self):
+        self.old_signal = signal.signal(self.signum, self.handler)
+        return self
+
+    def __exit__(self, *exc):
+        signal.signal(self.signum, self.old_signal)
+
+change_signal = ChangeSignal
+
+class ForwardWindowResize:
     '''
     Listen for window size change (SIGWINCH) and forward it
     to the terminal at input_fileno.
     If indirect is True, we send WS command to input_fileno.
     Otherwise, we set window size of input_fileno directly.
+    If selector is given, the signal handler only pokes a self-pipe
+    registered in it, and the resize is done from the caller's event
+    loop by calling the key's data.
     '''
-    stdin_fileno = sys.stdin.fileno()
-    def resize_window():
-        window_size = fcntl.ioctl(stdin_fileno, termios.TIOCGWINSZ, '00000000')
+    def __init__(self, input_fileno, indirect, selector=None):
+        self.input_fileno = input_fileno
+        self.indirect = indirect
+        self.selector = selector
+        self.stdin_fileno = sys.stdin.fileno()
+        # struct winsize is read into the same buffer on every resize. in
+        # indirect mode, the whole WS message is built once, and only its
+        # 8 payload bytes are overwritten in place.
+        self.window_size = bytearray(8)
         if indirect:
-            os.write(input_fileno, build_ctlseq(b'WS', window_size))
+            self.ws_msg = bytearray(build_ctlseq(b'WS', self.window_size))
+            self.ws_off = len(_begin_for(b'WS'))
+
+    def resize_window(self):
+        fcntl.ioctl(self.stdin_fileno, termios.TIOCGWINSZ,
+                    self.window_size, True)
+        if self.indirect:
+            self.ws_msg[self.ws_off:self.ws_off + 8] = self.window_size
+            os.write(self.input_fileno, self.ws_msg)
         else:
-            fcntl.ioctl(input_fileno, termios.TIOCSWINSZ, window_size)
-            
-    def new_signal_handler(signum, frame):
-        resize_window()
-
-    with change_signal(signal.SIGWINCH, new_signal_handler):
-        resize_window()
-        yield
-
-@contextlib.contextmanager
-def raw_tty():
-    STDIN_FILENO = sys.stdin.fileno()
-    try:
-        mode = tty.tcgetattr(STDIN_FILENO)
-        tty.setraw(STDIN_FILENO)
-        restore = 1
-    except tty.error:
-        restore = 0
+            fcntl.ioctl(self.input_fileno, termios.TIOCSWINSZ,
+                        self.window_size)
 
-    try:
-        yield
-    finally:
-        if restore:
-            tty.tcsetattr(STDIN_FILENO, tty.TCSAFLUSH, mode)
+    def on_signal(self, signum, frame):
+        self.resize_window()
+
+    def on_signal_poke(self, signum, frame):
+        try:
+            os.write(self.pipe_w, b'\0')
+        except BlockingIOError:
+            # a resize is pending anyway.
+            pass
+
+    def on_pipe_readable(self):
+        try:
+            while os.read(self.pipe_r, 64):
+                pass
+        except BlockingIOError:
+            pass
+        self.resize_window()
+
+    def __enter__(self):
+        if self.selector is None:
+            self.change_signal = ChangeSignal(signal.SIGWINCH,
+                                              self.on_signal)
+        else:
+            self.pipe_r, self.pipe_w = os.pipe()
+            set_blocking(self.pipe_r, False)
+            set_blocking(self.pipe_w, False)
+            self.selector.register(self.pipe_r, selectors.EVENT_READ,
+                                   self.on_pipe_readable)
+            self.change_signal = ChangeSignal(signal.SIGWINCH,
+                                              self.on_signal_poke)
+        self.change_signal.__enter__()
+        try:
+            self.resize_window()
+        except BaseException:
+            self.__exit__(*sys.exc_info())
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self.change_signal.__exit__(*exc)
+        finally:
+            if self.selector is not None:
+                self.selector.unregister(self.pipe_r)
+                os.close(self.pipe_r)
+                os.close(self.pipe_w)
+
+forward_window_resize = ForwardWindowResize
+
+class RawTTY:
+    '''
+    Put stdin into raw mode, and restore its mode on exit.
+    Does nothing if stdin is not a tty.
+    '''
+    def __enter__(self):
+        self.stdin_fileno = sys.stdin.fileno()
+        try:
+            self.mode = tty.tcgetattr(self.stdin_fileno)
+            tty.setraw(self.stdin_fileno)
+            self.restore = True
+        except tty.error:
+            self.restore = False
+        return self
+
+    def __exit__(self, *exc):
+        if self.restore:
+            tty.tcsetattr(self.stdin_fileno, tty.TCSAFLUSH, self.mode)
+
+raw_tty = RawTTY
 
 def lock_fd(fd):
     fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
 
+# fcntl only exposes F_SETPIPE_SZ since python 3.10. the value is the
+# same on every linux architecture, and other systems do not have it.
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ',
+                       1031 if sys.platform.startswith('linux') else None)
+
+def set_pipe_size(fd, size):
+    '''
+    Try to enlarge the kernel buffer of the pipe (or FIFO) at fd.
+    This is best-effort: it may be capped by fs.pipe-max-size or the
+    per-user pipe quota, and is a no-op off linux.
+    '''
+    if F_SETPIPE_SZ is None:
+        return
+    try:
+        fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except OSError:
+        pass
+
 def set_sync_output(fd):
     fl = fcntl.fcntl(fd, fcntl.F_GETFL)
     fl |= os.O_SYNC
     fcntl.fcntl(fd, fcntl.F_SETFL, fl)
 
+def set_blocking(fd, blocking):
+    # os.set_blocking is only there from python 3.5.
+    fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+    if blocking:
+        fl &= ~os.O_NONBLOCK
+    else:
+        fl |= os.O_NONBLOCK
+    fcntl.fcntl(fd, fcntl.F_SETFL, fl)
+
+class MultiPatternMatcher:
+    '''
+    Find which of a fixed set of patterns occur in a buffer.
+    With pyahocorasick, all patterns are found in one Aho-Corasick pass.
+    Without it, we fall back to one bytes.find per pattern. Control
+    sequences share a long common prefix; they are only searched for
+    when that prefix is present, which is rarely the case.
+    '''
+    def __init__(self, patterns):
+        self.patterns = [to_bytes(p) for p in patterns]
+        self.maxlen = max(len(p) for p in self.patterns)
+        self.ctlseq_prefix = build_ctlseq_prefix()
+        self.ctlseq_patterns = [p for p in self.patterns
+                                if p.startswith(self.ctlseq_prefix)]
+        self.other_patterns = [p for p in self.patterns
+                               if not p.startswith(self.ctlseq_prefix)]
+        self.automaton = None
+        if ahocorasick is not None:
+            # pyahocorasick works on str. latin-1 maps each byte to
+            # exactly one character, so indices are kept.
+            self.automaton = ahocorasick.Automaton()
+            for p in self.patterns:
+                self.automaton.add_word(p.decode('latin-1'), p)
+            self.automaton.make_automaton()
+
+    def find_all(self, data, min_end=0):
+        '''
+        Return the set of patterns that occur in data, only counting
+        occurrences that end at or after data[min_end].
+        '''
+        if self.automaton is not None:
+            return set(p for end_idx, p in
+                       self.automaton.iter(bytes(data).decode('latin-1'))
+                       if end_idx >= min_end)
+        patterns = self.other_patterns
+        if self.ctlseq_patterns and self.ctlseq_prefix in \
+           data[max(0, min_end - self.maxlen + 1):]:
+            patterns = patterns + self.ctlseq_patterns
+        return set(p for p in patterns
+                   if p in data[max(0, min_end - len(p) + 1):])
+
 # used to detect patterns that are split into two consecutive packets.
 class PatternFinder:
     def __init__(self):
-        self.tail_buf = bytes()
         self.BUFLEN = 100  # should be longer than the largest pattern
+        # ring buffer of the last BUFLEN bytes seen. cursor is where the
+        # next byte goes, and n_filled is how much of it is valid.
+        self.ring = bytearray(self.BUFLEN)
+        self.cursor = 0
+        self.n_filled = 0
 
     def append(self, data):
-        self.tail_buf = (self.tail_buf + data)[-self.BUFLEN:]
+        # only copy the part of data that we need to retain, straight
+        # from a view of it into the ring.
+        data = memoryview(data)[-self.BUFLEN:]
+        n = len(data)
+        first = min(n, self.BUFLEN - self.cursor)
+        self.ring[self.cursor:self.cursor + first] = data[:first]
+        self.ring[:n - first] = data[first:]
+        self.cursor = (self.cursor + n) % self.BUFLEN
+        self.n_filled = min(self.n_filled + n, self.BUFLEN)
 
-    def find_with_tail(self, data, pattern):
+    def tail(self, n):
+        '''
+        Return the last (at most) n bytes appended, in order.
+        '''
+        n = min(n, self.n_filled)
+        st = self.cursor - n
+        if st >= 0:
+            return bytes(self.ring[st:self.cursor])
+        return bytes(self.ring[st:] + self.ring[:self.cursor])
+
+    def find_with_tail(self, data, pattern, start=0):
+        '''
+        Find pattern in the tail + data[start:], without copying data.
+        Return None, or views of data before and after the pattern.
+        '''
         assert len(pattern) >= 2
         assert len(pattern) < self.BUFLEN
-        tail_head_len = min(len(pattern) - 1, len(self.tail_buf))
-        p = (self.tail_buf[-(len(pattern) - 1):] + data).find(pattern)
+        tail = self.tail(len(pattern) - 1)
+        # look at the seam between tail and data first, then at data
+        # itself, instead of searching a fresh tail + data copy. p is an
+        # offset into tail + data[start:] either way.
+        p = (tail + data[start:start + len(pattern) - 1]).find(pattern)
         if p < 0:
-            return None
-        before = data[:p - tail_head_len] if p >= tail_head_len else b''
-        after = data[p + len(pattern) - tail_head_len:]
+            p = data.find(pattern, start)
+            if p < 0:
+                return None
+            p += len(tail) - start
+        # zero-copy views. they are handed directly to os.write.
+        mv = memoryview(data)
+        before = mv[start:start + max(p - len(tail), 0)]
+        after = mv[start + p + len(pattern) - len(tail):]
         return (before, after)
+
+    def find_any_with_tail(self, data, matcher):
+        '''
+        Return the set of patterns in a MultiPatternMatcher that are
+        found in data, including the ones split between the tail and data.
+        '''
+        assert matcher.maxlen < self.BUFLEN
+        tail = self.tail(matcher.maxlen - 1)
+        return matcher.find_all(tail + data, len(tail))
@@ -9,24 +9,53 @@
 import pty
 import os
 import sys
+import errno
 import argparse
 import signal
-import select
+import socket
+import selectors
 import shutil
+import subprocess
 import atexit
 
 from rossh_common import \
     rossh_version_index, \
+    to_bytes, \
     build_ctlseq, \
     write_to, \
+    wait_writable, \
+    is_readable, \
     write_to_master_fd, \
     change_signal, \
     forward_window_resize, \
     raw_tty, \
+    set_pipe_size, \
+    set_blocking, \
     set_sync_output
 
 SHELL = os.environ.get('SHELL', 'sh')
 
+# read size of the relay loops. large enough to move a whole pipe or
+# pty buffer in one syscall during bulk output.
+READ_SIZE = 65536
+# how many READ_SIZE reads of the pty the daemon may drain in one wakeup
+# before it looks at the input again.
+MASTER_DRAIN_CHUNKS = 16
+# how long an attach waits for the session daemon to answer, in seconds.
+CONNECT_TIMEOUT = 10
+# sent by the session daemon on every connection it accepts.
+_HELLO = b'\x06'
+
+# control sequences sent to the client, built once, together with the
+# messages that go right along with them.
+_CONN_S = build_ctlseq(b'CONN:S')
+_CONN_E = build_ctlseq(b'CONN:E')
+_CONN_S_MSG = b'[RoSSH conn] connected to session\n' + _CONN_S
+_CONN_E_MSG = _CONN_E + b'[RoSSH conn] session exited\n'
+# after _CONN_S_MSG, so that the client shows it.
+_SESS_LOST_MSG = (b'[RoSSH session] the session daemon was dead, '
+                  b'started a new shell.\n')
+
 parser = argparse.ArgumentParser(
     description='RoSSH server script that creates and manages shells behind pseudo terminals.')
 
@@ -37,59 +66,283 @@ parser.add_argument('-t', dest='term', type=str, required=True,
 parser.add_argument('--kill', type=str, nargs='*',
                     help='Id of orphaned terminals to kill')
 
+def write_pidfile(path, pid):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        # bytes %-formatting is only there from python 3.5.
+        os.write(fd, str(pid).encode('ascii'))
+    finally:
+        os.close(fd)
+
+def read_pidfile(path):
+    # None if there is no such file.
+    try:
+        with open(path, 'rb') as f:
+            return int(f.read())
+    except FileNotFoundError:
+        return None
+
+def splice_drain(fd_in, relay_r, relay_w, fd_out):
+    '''
+    Splice what is readable at the non-blocking fd_in to fd_out, up to
+    MASTER_DRAIN_CHUNKS times READ_SIZE bytes. Neither end is a pipe, so
+    it goes through the empty pipe relay_r, relay_w.
+    Return True at EOF of fd_in.
+    '''
+    for _ in range(MASTER_DRAIN_CHUNKS):
+        try:
+            n = os.splice(fd_in, relay_w, READ_SIZE)
+        except BlockingIOError:
+            return False
+        if not n:
+            return True
+        while n:
+            try:
+                n -= os.splice(relay_r, fd_out, n)
+            except BlockingIOError:
+                wait_writable(fd_out)
+    return False
+
+def drain_input(fd, master_fd, pending):
+    '''
+    Write what is readable at the non-blocking fd to master_fd, up to
+    MASTER_DRAIN_CHUNKS times READ_SIZE bytes, see write_to_master_fd.
+    pending is what was held back of the last data.
+    Return what is held back now, or None at EOF of fd.
+    '''
+    for _ in range(MASTER_DRAIN_CHUNKS):
+        try:
+            data = os.read(fd, READ_SIZE)
+        except BlockingIOError:
+            break
+        except ConnectionResetError:
+            return None
+        if not data:
+            return None
+        if pending:
+            data = pending + data
+        pending = write_to_master_fd(master_fd, data)
+    else:
+        if is_readable(fd):
+            # the rest comes with the next wakeup.
+            return pending
+    # a WS escape is sent in one write, so the rest of one that was cut
+    # by the read size would be here already. what is held back now is
+    # just typed text, e.g. a single 'B', and must not wait for the next
+    # keystroke.
+    if pending:
+        pending = write_to_master_fd(master_fd, pending, hold_prefix=False)
+    return pending
+
 class Session:
     def __init__(self, term_id):
+        self.term_id = term_id
         self.RoSSH_DIRNAME = 'rossh.%s' % term_id
         self.RoSSH_DIR = '/tmp/%s' % self.RoSSH_DIRNAME
         self.RoSSH_SESS_PID_PATH = '%s/session.pid' % self.RoSSH_DIR
         self.RoSSH_CONN_PID_PATH = '%s/connection.pid' % self.RoSSH_DIR
         self.RoSSH_SOCK_PATH = '%s/auth.sock' % self.RoSSH_DIR
-        self.RoSSH_INPUT_PIPE_PATH = '%s/input' % self.RoSSH_DIR
-        self.RoSSH_OUTPUT_PIPE_PATH = '%s/output' % self.RoSSH_DIR
+        self.RoSSH_CONN_SOCK_PATH = '%s/conn.sock' % self.RoSSH_DIR
+
+    def copy_to_daemon(self, master_fd, shell_pid, listen_sock):
+        '''
+        Relay between the shell at master_fd and whoever connected last
+        to listen_sock, until the shell exits.
+        Return the exit status of shell_pid if it was reaped here,
+        or None.
+        '''
+        # master_fd is drained until it would block, into one buffer
+        # allocated for the lifetime of the daemon.
+        set_blocking(master_fd, False)
+        buf = bytearray(READ_SIZE * MASTER_DRAIN_CHUNKS)
+        buf_mv = memoryview(buf)
+
+        # the shell output is relayed to the connection untouched. where
+        # we can, it is spliced there without a copy through user space.
+        use_splice = hasattr(os, 'splice')
+        # splice needs a pipe at one end, the pty and the connection are
+        # not. one READ_SIZE splice has to fit in it.
+        relay_r, relay_w = os.pipe()
+        set_blocking(relay_r, False)
+        set_pipe_size(relay_w, READ_SIZE)
+
+        sel = selectors.DefaultSelector()
+        # bound once, not looked up on every wakeup.
+        read = os.read
+        readv = os.readv
+        _write_to = write_to
+
+        # the current client connection. while there is none, the shell
+        # output is not read and waits in the pty.
+        conn = None
+        conn_fileno = None
+        # the start of a WS escape cut off at the end of the last read.
+        pending = b''
+
+        def drop_conn():
+            nonlocal conn, conn_fileno
+            # the client has gone, it may come back later.
+            sel.unregister(conn_fileno)
+            sel.unregister(master_fd)
+            conn.close()
+            conn = conn_fileno = None
+            # output spliced half way to it is lost with it.
+            try:
+                while read(relay_r, READ_SIZE):
+                    pass
+            except BlockingIOError:
+                pass
 
-    def copy_to_daemon(self, master_fd):
-        f_input = open(self.RoSSH_INPUT_PIPE_PATH, 'r')
-        f_input_fileno = f_input.fileno()
-        f_output = open(self.RoSSH_OUTPUT_PIPE_PATH, 'w')
-        f_output_fileno = f_output.fileno()
+        # each fd is registered with its handler as data. a handler
+        # returns True when the shell is gone.
+        def on_master():
+            nonlocal use_splice
+            if conn is None:
+                # dropped by a handler before us in the same wakeup.
+                return False
+            try:
+                if use_splice:
+                    try:
+                        return splice_drain(master_fd, relay_r, relay_w,
+                                            conn_fileno)
+                    except OSError as e:
+                        if e.errno != errno.EINVAL:
+                            raise
+                        # this kernel can not splice from a pty. copy
+                        # through user space from now on.
+                        use_splice = False
+
+                n = 0
+                is_eof = False
+                while n < len(buf):
+                    try:
+                        nread = readv(master_fd, [buf_mv[n:n + READ_SIZE]])
+                    except BlockingIOError:
+                        break
+                    except OSError:
+                        # the shell has gone (EIO). flush what we have
+                        # got first, the error shows up again next cycle.
+                        if n:
+                            break
+                        raise
+                    if not nread:
+                        is_eof = True
+                        break
+                    n += nread
+                if n:
+                    _write_to(conn_fileno, buf_mv[:n])
+                return is_eof
+            except (BrokenPipeError, ConnectionResetError):
+                drop_conn()
+                return False
+
+        def on_accept():
+            nonlocal conn, conn_fileno, pending
+            new_conn, _ = listen_sock.accept()
+            try:
+                # tells the attach that we are alive, see connect().
+                new_conn.sendall(_HELLO)
+            except (BrokenPipeError, ConnectionResetError):
+                new_conn.close()
+                return False
+            new_conn.setblocking(False)
+            if conn is None:
+                sel.register(master_fd, selectors.EVENT_READ, on_master)
+            else:
+                # a new connection takes over from one that has not
+                # noticed yet that it is gone.
+                sel.unregister(conn_fileno)
+                conn.close()
+            conn = new_conn
+            conn_fileno = conn.fileno()
+            pending = b''
+            sel.register(conn_fileno, selectors.EVENT_READ, on_input)
+            return False
 
-        try:
-            fds = [master_fd, f_input_fileno]
-            while True:
-                rfds, _, _ = select.select(fds, [], [])
+        def on_input():
+            nonlocal pending
+            if conn is None:
+                return False
+            # drain the input too, e.g. a large paste.
+            pending = drain_input(conn_fileno, master_fd, pending)
+            if pending is None:
+                # an input EOF may actually means the connection
+                # has broken and would reconnect later. so we just
+                # wait for the next one.
+                pending = b''
+                drop_conn()
+            return False
 
-                if master_fd in rfds:
-                    data = os.read(master_fd, 1024)
-                    if not data:
-                        break
-                    else:
-                        write_to(f_output_fileno, data)
-
-                if f_input_fileno in rfds:
-                    data = os.read(f_input_fileno, 1024)
-                    if not data:
-                        # an input EOF may actually means the connection
-                        # has broken and would reconnect later. so we just
-                        # reopen the pipe.
-                        fds.remove(f_input_fileno)
-                        f_input.close()
-                        f_input = open(self.RoSSH_INPUT_PIPE_PATH, 'r')
-                        f_input_fileno = f_input.fileno()
-                        fds.append(f_input_fileno)
-                    else:
-                        write_to_master_fd(master_fd, data)
+        # SIGCHLD wakes the loop through a pipe, see signal.set_wakeup_fd.
+        # so the session ends when the shell exits, even if a background
+        # job still holds the pty open and master_fd never reports EOF.
+        shell_status = None
+        chld_r, chld_w = os.pipe()
+        set_blocking(chld_r, False)
+        set_blocking(chld_w, False)
+
+        def on_child():
+            nonlocal shell_status
+            try:
+                while read(chld_r, 64):
+                    pass
+            except BlockingIOError:
+                pass
+            pid, status = os.waitpid(shell_pid, os.WNOHANG)
+            if pid == 0:
+                return False
+            shell_status = status
+            # pass on the last output of the shell before we leave.
+            if conn is not None:
+                try:
+                    on_master()
+                except OSError:
+                    pass
+            return True
+
+        old_wakeup_fd = None
+        try:
+            listen_sock.setblocking(False)
+            sel.register(listen_sock, selectors.EVENT_READ, on_accept)
+            sel.register(chld_r, selectors.EVENT_READ, on_child)
+            select = sel.select
+            # the wakeup fd is only written for signals with a python
+            # handler. the default action of SIGCHLD is to ignore it.
+            with change_signal(signal.SIGCHLD, lambda signum, frame: None):
+                old_wakeup_fd = signal.set_wakeup_fd(chld_w)
+                # a SIGCHLD that came before the wakeup fd was set left
+                # nothing in the pipe. the shell may be gone already.
+                is_done = on_child()
+                while not is_done:
+                    for key, _ in select():
+                        if key.data():
+                            is_done = True
+                            break
         finally:
-            f_output.close()
-            f_input.close()
+            if old_wakeup_fd is not None:
+                signal.set_wakeup_fd(old_wakeup_fd)
+            sel.close()
+            os.close(chld_r)
+            os.close(chld_w)
+            os.close(relay_r)
+            os.close(relay_w)
+            if conn is not None:
+                conn.close()
+            listen_sock.close()
+        return shell_status
 
     def create_session_daemon(self):
-        os.mkfifo(self.RoSSH_INPUT_PIPE_PATH)
-        os.mkfifo(self.RoSSH_OUTPUT_PIPE_PATH)
+        # input and output go over a listening unix socket: every attach
+        # connects anew, with no FIFO to reopen. it is listening before
+        # the fork, so the first attach can connect right away.
+        listen_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listen_sock.bind(self.RoSSH_CONN_SOCK_PATH)
+        listen_sock.listen(1)
         
         child_pid = os.fork()
         if child_pid != 0:
-            with open(self.RoSSH_SESS_PID_PATH, 'w') as f:
-                f.write(str(child_pid))
+            listen_sock.close()
+            write_pidfile(self.RoSSH_SESS_PID_PATH, child_pid)
             return
         
         # below runs in the session daemon, and exits.
@@ -116,38 +369,99 @@ class Session:
                 pass
             raise OSError('External termination received')
             
+        retv = None
         with change_signal(signal.SIGTERM, sigterm_handler):
             try:
-                self.copy_to_daemon(master_fd)
+                retv = self.copy_to_daemon(master_fd, shell_pid,
+                                           listen_sock)
             except OSError:
                 pass
 
         os.close(master_fd)
-        retv = os.waitpid(shell_pid, 0)[1]
+        if retv is None:
+            retv = os.waitpid(shell_pid, 0)[1]
         # print('[RoSSH debug] shell exited.')
 
         # sys.stdout.write('\r[RoSSH session] shell exited with status %d.\r\n' % retv)
         sys.exit(0)
 
     def create_if_not_exists(self):
-        if os.path.exists(self.RoSSH_DIR):
+        try:
+            os.mkdir(self.RoSSH_DIR, 0o700)
+        except FileExistsError:
             return
-        os.mkdir(self.RoSSH_DIR, 0o700)
         self.create_session_daemon()
 
-    def attach(self):
-        if os.path.exists(self.RoSSH_CONN_PID_PATH):
-            # kill the previous connection.
-            with open(self.RoSSH_CONN_PID_PATH) as f:
-                old_pid = int(f.read())
+    def link_auth_sock(self):
+        if 'SSH_AUTH_SOCK' in os.environ:
             try:
-                # different from SIGHUP to avoid file remove race condition
-                os.kill(old_pid, signal.SIGINT)
-            except ProcessLookupError:
+                os.unlink(self.RoSSH_SOCK_PATH)
+            except FileNotFoundError:
                 pass
+            os.symlink(os.environ['SSH_AUTH_SOCK'], self.RoSSH_SOCK_PATH)
+
+    def is_own_pid(self, pid):
+        '''
+        Tell if pid is still a RoSSH server process of this session.
+        The pid in a pid file may have been reused since.
+        '''
+        try:
+            with open('/proc/%d/cmdline' % pid, 'rb') as f:
+                args = f.read().split(b'\0')
+        except FileNotFoundError:
+            if os.path.isdir('/proc/self'):
+                return False
+            # no procfs, e.g. macOS.
+            try:
+                args = subprocess.check_output(
+                    ['ps', '-o', 'command=', '-p', str(pid)]).split()
+            except (subprocess.CalledProcessError, OSError):
+                return False
+        except PermissionError:
+            return False
+        return (any(a.endswith(b'rossh_server.py') for a in args) and
+                to_bytes(self.term_id) in args)
 
-        with open(self.RoSSH_CONN_PID_PATH, 'w') as f:
-            f.write(str(os.getpid()))
+    def kill_pidfile(self, path, signum):
+        # the pid file is simply missing if there is no such process.
+        pid = read_pidfile(path)
+        if pid is None or pid == os.getpid() or not self.is_own_pid(pid):
+            return
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def connect(self):
+        '''
+        Connect to the session daemon, and wait for it to say hello.
+        Return the connection, or None if the daemon is gone.
+        '''
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # a daemon that is still exiting may be listening, but never
+        # accepts. so it has to answer in time.
+        conn.settimeout(CONNECT_TIMEOUT)
+        try:
+            conn.connect(self.RoSSH_CONN_SOCK_PATH)
+            is_alive = conn.recv(1) == _HELLO
+        except (FileNotFoundError, ConnectionRefusedError,
+                ConnectionResetError, socket.timeout):
+            is_alive = False
+        if not is_alive:
+            conn.close()
+            return None
+        return conn
+
+    def attach(self, notice=b''):
+        '''
+        Connect this terminal to the session until the shell exits.
+        notice is shown to the user right after connecting.
+        Return False if the session daemon is gone.
+        '''
+        # different from SIGHUP to avoid file remove race condition
+        self.kill_pidfile(self.RoSSH_CONN_PID_PATH, signal.SIGINT)
+        # before connecting, so the connection we take over can tell.
+        write_pidfile(self.RoSSH_CONN_PID_PATH, os.getpid())
 
         def onhup_delpid(signum, frame):
             try:
@@ -159,70 +473,104 @@ class Session:
 
         signal.signal(signal.SIGHUP, onhup_delpid)
         
-        rssh_input = open(self.RoSSH_INPUT_PIPE_PATH, 'w')
-        rssh_input_fileno = rssh_input.fileno()
-        rssh_output = open(self.RoSSH_OUTPUT_PIPE_PATH, 'r')
-        rssh_output_fileno = rssh_output.fileno()
+        conn = self.connect()
+        if conn is None:
+            return False
+        conn_fileno = conn.fileno()
+        # the output is drained until it would block. stdin stays
+        # blocking: O_NONBLOCK is shared by everyone holding the same
+        # open tty.
+        conn.setblocking(False)
         stdin_fileno = sys.stdin.fileno()
         stdout_fileno = sys.stdout.fileno()
         set_sync_output(stdout_fileno)
         
-        sys.stdout.write("[RoSSH conn] connected to session\n")
-        write_to(stdout_fileno, build_ctlseq(b'CONN:S'))
+        # one write for the message and the control sequence. anything
+        # buffered in sys.stdout has to go out before them.
+        sys.stdout.flush()
+        write_to(stdout_fileno, _CONN_S_MSG + notice)
+
+        # DefaultSelector is epoll on linux. the fds are registered once
+        # per connection, instead of being handed to the kernel again on
+        # every keystroke.
+        sel = selectors.DefaultSelector()
+        # one scratch buffer per direction, reused for every read.
+        buf_in = bytearray(READ_SIZE)
+        buf_in_mv = memoryview(buf_in)
+        buf_out = bytearray(READ_SIZE)
+        buf_out_mv = memoryview(buf_out)
+        readv = os.readv
+        _write_to = write_to
+
+        # handlers registered as the keys' data. they return True
+        # when the shell has exited.
+        def on_stdin():
+            n = readv(stdin_fileno, [buf_in])
+            if not n:
+                sys.stdout.write("[RoSSH conn] unexpected input EOF\n")
+                sys.exit(1)
+            try:
+                _write_to(conn_fileno, buf_in_mv[:n])
+            except (BrokenPipeError, ConnectionResetError):
+                # like an EOF of the output.
+                return True
+            return False
 
-        with raw_tty(), forward_window_resize(rssh_input_fileno, indirect=True):
-            fds = [stdin_fileno, rssh_output_fileno]
-            
-            while True:
-                rfds, _, _ = select.select(fds, [], [])
-                
-                if stdin_fileno in rfds:
-                    data = os.read(stdin_fileno, 1024)
-                    if not data:
-                        sys.stdout.write("[RoSSH conn] unexpected input EOF\n")
-                        sys.exit(1)
-                    else:
-                        write_to(rssh_input_fileno, data)
-
-                if rssh_output_fileno in rfds:
-                    data = os.read(rssh_output_fileno, 1024)
-                    if not data:
-                        # shell exited
-                        break
-                    else:
-                        write_to(stdout_fileno, data)
+        def on_output():
+            for _ in range(MASTER_DRAIN_CHUNKS):
+                try:
+                    n = readv(conn_fileno, [buf_out])
+                except BlockingIOError:
+                    break
+                except ConnectionResetError:
+                    n = 0
+                if not n:
+                    # shell exited, or we were taken over
+                    return True
+                _write_to(stdout_fileno, buf_out_mv[:n])
+            return False
+
+        try:
+            sel.register(stdin_fileno, selectors.EVENT_READ, on_stdin)
+            sel.register(conn_fileno, selectors.EVENT_READ, on_output)
+            select = sel.select
+            # the resize is done from this loop, via a self-pipe. so a WS
+            # message can not land in the middle of a partial write of
+            # stdin data to the connection.
+            with raw_tty(), forward_window_resize(conn_fileno,
+                                                  indirect=True,
+                                                  selector=sel):
+                is_done = False
+                while not is_done:
+                    for key, _ in select():
+                        if key.data():
+                            is_done = True
+                            break
+        finally:
+            sel.close()
+            conn.close()
+
+        if read_pidfile(self.RoSSH_CONN_PID_PATH) != os.getpid():
+            # another connection has taken over the session.
+            sys.exit(1)
 
         # session terminated. cleanup.
         shutil.rmtree(self.RoSSH_DIR)
         
-        write_to(stdout_fileno, build_ctlseq(b'CONN:E'))
-        sys.stdout.write("[RoSSH conn] session exited\n")
+        sys.stdout.flush()
+        write_to(stdout_fileno, _CONN_E_MSG)
+        return True
 
     def destroy_if_exists(self):
-        if os.path.exists(self.RoSSH_DIR):
-            if os.path.exists(self.RoSSH_CONN_PID_PATH):
-                # kill the previous connection.
-                with open(self.RoSSH_CONN_PID_PATH) as f:
-                    old_pid = int(f.read())
-
-                try:
-                    os.kill(old_pid, signal.SIGHUP)
-                except ProcessLookupError: pass
-
-            if os.path.exists(self.RoSSH_SESS_PID_PATH):
-                # kill the session
-                with open(self.RoSSH_SESS_PID_PATH) as f:
-                    old_pid = int(f.read())
-
-                try:
-                    os.kill(old_pid, signal.SIGTERM)
-                except ProcessLookupError: pass
+        # kill the previous connection, and the session.
+        self.kill_pidfile(self.RoSSH_CONN_PID_PATH, signal.SIGHUP)
+        self.kill_pidfile(self.RoSSH_SESS_PID_PATH, signal.SIGTERM)
 
+        try:
             shutil.rmtree(self.RoSSH_DIR)
-            return True
-        
-        else:
+        except FileNotFoundError:
             return False
+        return True
 
 if __name__ == '__main__':
     args = parser.parse_args()
@@ -244,12 +592,14 @@ if __name__ == '__main__':
     
     sess = Session(args.term)
     sess.create_if_not_exists()
-    
-    if 'SSH_AUTH_SOCK' in os.environ:
-        try:
-            os.unlink(sess.RoSSH_SOCK_PATH)
-        except FileNotFoundError:
-            pass
-        os.symlink(os.environ['SSH_AUTH_SOCK'], sess.RoSSH_SOCK_PATH)
-
-    sess.attach()
+    sess.link_auth_sock()
+
+    if not sess.attach():
+        # e.g. the daemon was killed, or the host rebooted.
+        sess.destroy_if_exists()
+        sess.create_if_not_exists()
+        sess.link_auth_sock()
+        if not sess.attach(_SESS_LOST_MSG):
+            print('[RoSSH session] session daemon does not answer.',
+                  flush=True)
+            sys.exit(1)
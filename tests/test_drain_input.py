@@ -0,0 +1,64 @@
+import os
+import sys
+import pty
+import tty
+import socket
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rossh_server
+from rossh_server import drain_input
+
+class TestDrainInput(unittest.TestCase):
+    '''
+    Drain a connection into a pty with a small read size, to get at the
+    end of the drain limit.
+    '''
+    def setUp(self):
+        self.master_fd, self.slave_fd = pty.openpty()
+        tty.setraw(self.slave_fd)
+        self.conn, self.peer = socket.socketpair()
+        self.conn.setblocking(False)
+        patcher = mock.patch.multiple(rossh_server, READ_SIZE=8,
+                                      MASTER_DRAIN_CHUNKS=2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.conn.close()
+        self.peer.close()
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+    def read_slave(self, n):
+        got = b''
+        while len(got) < n:
+            got += os.read(self.slave_fd, n - len(got))
+        return got
+
+    def test_limit_ends_in_b(self):
+        # exactly READ_SIZE * MASTER_DRAIN_CHUNKS bytes, nothing after.
+        data = b'abcdefghijklmnoB'
+        self.peer.sendall(data)
+        pending = drain_input(self.conn.fileno(), self.master_fd, b'')
+        self.assertEqual(pending, b'')
+        self.assertEqual(self.read_slave(len(data)), data)
+
+    def test_limit_with_more_to_come(self):
+        data = b'abcdefghijklmnoB' + b'xyz'
+        self.peer.sendall(data)
+        pending = drain_input(self.conn.fileno(), self.master_fd, b'')
+        self.assertEqual(pending, b'B')
+        pending = drain_input(self.conn.fileno(), self.master_fd, pending)
+        self.assertEqual(pending, b'')
+        self.assertEqual(self.read_slave(len(data)), data)
+
+    def test_eof(self):
+        self.peer.close()
+        self.assertIsNone(
+            drain_input(self.conn.fileno(), self.master_fd, b''))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import sys
+import pty
+import tty
+import fcntl
+import struct
+import termios
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rossh_common import write_to_master_fd, ctlseq_begin, ctlseq_special, ctlseq_end
+
+class TestWriteToMasterFd(unittest.TestCase):
+    '''
+    Feed a WS escape cut at every point and check that the pty gets the
+    text around it untouched and the window size from it.
+    '''
+    def setUp(self):
+        self.master_fd, self.slave_fd = pty.openpty()
+        tty.setraw(self.slave_fd)
+
+    def tearDown(self):
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+    def read_slave(self, n):
+        got = b''
+        while len(got) < n:
+            got += os.read(self.slave_fd, n - len(got))
+        return got
+
+    def get_winsize(self):
+        return fcntl.ioctl(self.slave_fd, termios.TIOCGWINSZ, b'\0' * 8)
+
+    def test_cut_points(self):
+        before, after = b'ls B', b'Bx\n'
+        for k in range(1, 38):
+            ws = struct.pack('HHHH', 10 + k, 80 + k, 0, 0)
+            esc = ctlseq_begin + ctlseq_special + b'WS' + ws + ctlseq_end
+            self.assertEqual(len(esc), 38)
+            data = before + esc + after
+            cut = len(before) + k
+            pending = write_to_master_fd(self.master_fd, data[:cut])
+            pending = write_to_master_fd(self.master_fd, pending + data[cut:])
+            self.assertEqual(pending, b'')
+            self.assertEqual(self.read_slave(len(before + after)),
+                             before + after)
+            self.assertEqual(self.get_winsize(), ws)
+
+    def test_lone_prefix_flush(self):
+        pending = write_to_master_fd(self.master_fd, b'abcB')
+        self.assertEqual(pending, b'B')
+        pending = write_to_master_fd(self.master_fd, pending,
+                                     hold_prefix=False)
+        self.assertEqual(pending, b'')
+        self.assertEqual(self.read_slave(4), b'abcB')
+
+if __name__ == '__main__':
+    unittest.main()